@@ -1,26 +1,35 @@
 # app.py
 
+import asyncio
+import os
 import gradio as gr
 import pandas as pd
-import textstat
 import time
 import itertools
-import plotly.express as px # For visualizations
+from concurrent.futures.process import BrokenProcessPool
+import plotly.graph_objects as go # For visualizations
 
 # Import our custom modules
-from config import LLM_MODELS_FOR_TESTING, HEALTH_PROFILES
-from llm_handler import get_ollama_response, get_ollama_response_non_stream
+from config import LLM_MODELS_FOR_TESTING, PROFILE_BY_NAME, SCENARIO_NAMES
+from metrics import safe_readability, get_readability_pool, reset_readability_pool
+from llm_handler import get_ollama_response, get_ollama_response_async, warmup_models, RESPONSE_CACHE_ENABLED
 
-# --- Logging Setup ---
-print("--- Local LLM Health Advisor ---")
-print("Models available for testing:", list(LLM_MODELS_FOR_TESTING.keys()))
-print("Scenarios available:", [p['scenario_name'] for p in HEALTH_PROFILES])
-print("---------------------------------")
+# Display names for the model selectors, built once and shared by every component
+MODEL_NAMES = list(LLM_MODELS_FOR_TESTING.keys())
 
-# --- Helper Function to build the prompt ---
-def build_prompts(selected_profile):
-    """Builds the system and user prompts for a given scenario."""
-    system_prompt = f"""You are a helpful and empathetic AI health advisor. Your goal is to provide safe, actionable, and clear health advice based on a user's profile and question.
+def resolve_model(display_name):
+    """
+    Returns the (Ollama model name, runtime options) for a display name.
+    Accepts both config formats: a plain model tag string, or a {"name", "options"} dict.
+    """
+    entry = LLM_MODELS_FOR_TESTING[display_name]
+    if isinstance(entry, str):
+        return entry, None
+    return entry["name"], entry.get("options")
+
+# --- System Prompt ---
+# The system prompt is the same for every scenario, so it is built once at import.
+SYSTEM_PROMPT = """You are a helpful and empathetic AI health advisor. Your goal is to provide safe, actionable, and clear health advice based on a user's profile and question.
 
 **Your Core Directives:**
 1.  **Analyze the User's Context:** Carefully review the provided patient profile, primary concern, and key information points.
@@ -33,6 +42,11 @@ def build_prompts(selected_profile):
 
 Do not repeat the user's context or your directives in the response. Begin the advice directly.
 """
+PROMPT_DISPLAY_PREFIX = f"### System Prompt\n---\n{SYSTEM_PROMPT}\n\n### User Prompt\n---\n"
+
+# --- Helper Function to build the prompt ---
+def build_prompts(selected_profile):
+    """Builds the system and user prompts for a given scenario."""
     user_prompt = f"""**Patient Context:**
 - **Profile:** {selected_profile['profile_text']}
 - **Primary Concern:** {selected_profile['target_disease_context']}
@@ -42,13 +56,16 @@ Do not repeat the user's context or your directives in the response. Begin the a
 **User's Question:** "{selected_profile['user_question']}"
 """
     messages = [
-        {'role': 'system', 'content': system_prompt},
+        {'role': 'system', 'content': SYSTEM_PROMPT},
         {'role': 'user', 'content': user_prompt},
     ]
-    prompt_for_display = f"### System Prompt\n---\n{system_prompt}\n\n### User Prompt\n---\n{user_prompt}"
+    prompt_for_display = PROMPT_DISPLAY_PREFIX + user_prompt
     return messages, prompt_for_display
 
 # --- Single Evaluation Function (Streaming) ---
+# Minimum time between UI updates while streaming, in seconds. Tokens arriving in between are batched.
+STREAM_YIELD_INTERVAL = 0.04
+
 def generate_and_evaluate_stream(model_display_name, scenario_name, progress=gr.Progress(track_tqdm=True)):
     """
     Core streaming function for single evaluations.
@@ -57,113 +74,225 @@ def generate_and_evaluate_stream(model_display_name, scenario_name, progress=gr.
         yield "Please select a model and a scenario.", "", "No stats.", ""
         return
 
-    model_id = LLM_MODELS_FOR_TESTING[model_display_name]
-    selected_profile = next((p for p in HEALTH_PROFILES if p['scenario_name'] == scenario_name), None)
+    model_id, model_options = resolve_model(model_display_name)
+    selected_profile = PROFILE_BY_NAME.get(scenario_name)
 
     if not selected_profile:
         yield "Error: Profile not found.", "", "Error.", ""
         return
 
     messages, prompt_for_display = build_prompts(selected_profile)
-    advice_stream = get_ollama_response(model_id, messages)
+    advice_stream = get_ollama_response(model_id, messages, model_options)
     
     profile_display = f"### {selected_profile['scenario_name']}\n**Profile:** {selected_profile['profile_text']}"
     
     start_time = time.time()
-    advice_text = ""
+    # Collect chunks in a list and join only when updating the UI, instead of growing a string per token
+    parts = []
     yield profile_display, "...", "Generating...", prompt_for_display
+    last_yield = time.monotonic()
 
-    for chunk in progress.tqdm(advice_stream, desc=f"Generating for {model_display_name}"):
-        if "ERROR:" in chunk:
+    for kind, chunk in progress.tqdm(advice_stream, desc=f"Generating for {model_display_name}"):
+        if kind == "error":
             advice_text = chunk
             yield profile_display, advice_text, "Error occurred.", prompt_for_display
             return
-        advice_text += chunk
-        yield profile_display, advice_text, "Generating...", prompt_for_display
+        parts.append(chunk)
+        # Only push an update every STREAM_YIELD_INTERVAL seconds; the final yield below flushes the rest.
+        # The profile, status and prompt were sent above, so only the advice text is updated here.
+        if time.monotonic() - last_yield > STREAM_YIELD_INTERVAL:
+            yield gr.update(), "".join(parts), gr.update(), gr.update()
+            last_yield = time.monotonic()
+
+    advice_text = "".join(parts)
 
     response_time = time.time() - start_time
     
-    if "ERROR:" not in advice_text:
-        flesch_score = textstat.flesch_reading_ease(advice_text)
-        grade_level = textstat.flesch_kincaid_grade(advice_text)
+    # Errors return early above, so anything reaching this point is a generated response
+    flesch_score, grade_level = safe_readability(advice_text)
+    if flesch_score is not None:
         stats = (f"**Response Time:** {response_time:.2f}s\n"
                  f"**Readability (Flesch Ease):** {flesch_score:.1f}\n"
                  f"**Grade Level (FK):** {grade_level:.1f}")
     else:
-        stats = f"Generation failed.\nTime: {response_time:.2f}s\n\n**Details:**\n{advice_text}"
-        advice_text = "An error occurred. See 'Stats' box for details."
-        
+        stats = (f"**Response Time:** {response_time:.2f}s\n"
+                 f"**Readability:** Not scored (response too short)")
+
     yield profile_display, advice_text, stats, prompt_for_display
 
 # --- Batch Evaluation Function (Non-Streaming) ---
-def batch_evaluate(model_display_names, scenario_names, progress=gr.Progress(track_tqdm=True)):
+# Columns of the batch results table, and the subset used for the plots
+RESULT_COLUMNS = ["Model", "Scenario", "Response Time (s)", "Flesch Ease", "Flesch-Kincaid Grade", "Cached", "Advice"]
+VIZ_COLUMNS = ["Model", "Scenario", "Response Time (s)", "Flesch Ease", "Flesch-Kincaid Grade"]
+# Number of requests sent to Ollama at the same time. Match this to the server's OLLAMA_NUM_PARALLEL.
+# Batch response times are measured under this much concurrency; set it to 1 for sequential latencies.
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+# Number of batch tasks kept alive at once, so large grids don't spawn every request up front.
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", str(OLLAMA_NUM_PARALLEL)))
+
+async def batch_evaluate(model_display_names, scenario_names, bypass_cache=False, progress=gr.Progress(track_tqdm=True)):
     """
     Runs evaluation for all combinations of selected models and scenarios.
+    Requests are sent concurrently, up to OLLAMA_NUM_PARALLEL at a time, from a
+    sliding window of MAX_INFLIGHT tasks.
     """
     if not model_display_names or not scenario_names:
-        # Return empty dataframe and a message
-        return pd.DataFrame(), "Please select at least one model and one scenario.", gr.update(visible=False)
+        # Return empty dataframe, a message and empty plots
+        return pd.DataFrame(), "Please select at least one model and one scenario.", gr.update(visible=False), None, None, None
+
+    # Load every selected model up front so timings don't include model load time
+    progress(0, desc="Loading models")
+    await warmup_models(dict(resolve_model(m) for m in model_display_names))
 
-    results = []
     evaluation_pairs = list(itertools.product(model_display_names, scenario_names))
-    
-    for model_name, scenario_name in progress.tqdm(evaluation_pairs, desc="Running Batch Evaluation"):
-        model_id = LLM_MODELS_FOR_TESTING[model_name]
-        selected_profile = next((p for p in HEALTH_PROFILES if p['scenario_name'] == scenario_name), None)
-
-        if not selected_profile:
-            results.append({
-                "Model": model_name, "Scenario": scenario_name, "Response Time (s)": 0,
-                "Flesch Ease": None, "Flesch-Kincaid Grade": None, "Advice": "Scenario not found."
-            })
-            continue
+    sem = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+
+    # Prompts only depend on the scenario, so build each one once and reuse it for every model
+    prompt_cache = {s: build_prompts(PROFILE_BY_NAME[s]) for s in scenario_names if s in PROFILE_BY_NAME}
 
-        messages, _ = build_prompts(selected_profile)
-        advice_text, response_time = get_ollama_response_non_stream(model_id, messages)
+    def error_row(model_name, scenario_name, message):
+        return {
+            "Model": model_name, "Scenario": scenario_name, "Response Time (s)": 0,
+            "Flesch Ease": None, "Flesch-Kincaid Grade": None, "Cached": False, "Advice": message
+        }
 
-        if "ERROR:" not in advice_text and advice_text:
-            flesch_score = textstat.flesch_reading_ease(advice_text)
-            grade_level = textstat.flesch_kincaid_grade(advice_text)
+    async def run_one(model_name, scenario_name):
+        model_id, model_options = resolve_model(model_name)
+
+        if scenario_name not in prompt_cache:
+            return error_row(model_name, scenario_name, "Scenario not found."), False
+
+        messages, _ = prompt_cache[scenario_name]
+        async with sem:
+            advice_text, response_time, status = await get_ollama_response_async(
+                model_id, messages, model_options, use_cache=not bypass_cache)
+
+        is_error = status == "error"
+        if is_error:
+            # Nothing to score, so skip the round trip to the worker pool
+            flesch_score, grade_level = safe_readability(advice_text, is_error)
         else:
-            flesch_score, grade_level = None, None
+            loop = asyncio.get_running_loop()
+            pool = get_readability_pool(MAX_INFLIGHT)
+            try:
+                flesch_score, grade_level = await loop.run_in_executor(pool, safe_readability, advice_text)
+            except BrokenProcessPool:
+                # A worker died; score this response here and let the next call build a fresh pool
+                reset_readability_pool(pool)
+                flesch_score, grade_level = safe_readability(advice_text)
 
-        results.append({
+        return {
             "Model": model_name,
             "Scenario": scenario_name,
             "Response Time (s)": float(f"{response_time:.2f}"),
             "Flesch Ease": float(f"{flesch_score:.1f}") if isinstance(flesch_score, (int, float)) else None,
             "Flesch-Kincaid Grade": float(f"{grade_level:.1f}") if isinstance(grade_level, (int, float)) else None,
+            # Cached rows show the response time of the original request
+            "Cached": status == "cached",
             "Advice": advice_text
-        })
-    
-    results_df = pd.DataFrame(results)
-    # Return the dataframe, a success message, and make the visualization accordion visible
-    return results_df, f"Batch evaluation complete. Ran {len(results_df)} tests.", gr.update(visible=True)
+        }, not is_error
+
+    # Keep at most MAX_INFLIGHT tasks alive; start a new one each time one finishes.
+    results = [None] * len(evaluation_pairs)
+    # Whether each pair produced a response; only these rows are plotted
+    succeeded = [False] * len(evaluation_pairs)
+    task_index = {}
+    pending = set()
+    completed = 0
+    progress((0, len(evaluation_pairs)), desc="Running Batch Evaluation", unit="tests")
+
+    def collect(done):
+        nonlocal completed
+        for task in done:
+            i = task_index.pop(task)
+            try:
+                results[i], succeeded[i] = task.result()
+            except Exception as e:
+                # One failing pair becomes an error row instead of aborting the whole grid
+                model_name, scenario_name = evaluation_pairs[i]
+                results[i] = error_row(model_name, scenario_name, f"ERROR: Evaluation failed. Details: {e}")
+            completed += 1
+        progress((completed, len(evaluation_pairs)), desc="Running Batch Evaluation", unit="tests")
+
+    try:
+        for i, (model_name, scenario_name) in enumerate(evaluation_pairs):
+            task = asyncio.create_task(run_one(model_name, scenario_name))
+            task_index[task] = i
+            pending.add(task)
+            if len(pending) >= MAX_INFLIGHT:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                collect(done)
+
+        # Drain whatever is still running
+        if pending:
+            done, pending = await asyncio.wait(pending)
+            collect(done)
+    finally:
+        # On cancel (e.g. the Cancel button) or an unexpected error, stop the requests still running
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    results_df = pd.DataFrame.from_records(results, columns=RESULT_COLUMNS)
+    # Only successful requests are plotted; failed pairs are filtered here by their status
+    viz_df = pd.DataFrame.from_records(
+        [r for r, ok in zip(results, succeeded) if ok],
+        columns=VIZ_COLUMNS,
+    )
+    # Keep the plot axes in the order the user selected models and scenarios
+    category_orders = {"Model": list(model_display_names), "Scenario": list(scenario_names)}
+    fig_time, fig_ease, fig_grade = update_visualizations(viz_df, category_orders)
+    status = f"Batch evaluation complete. Ran {len(results_df)} tests."
+    if OLLAMA_NUM_PARALLEL > 1:
+        status += (f" Response times were measured with up to {OLLAMA_NUM_PARALLEL} concurrent requests"
+                   " (set OLLAMA_NUM_PARALLEL=1 for sequential timings).")
+    cached_count = sum(r["Cached"] for r in results)
+    if cached_count:
+        status += f" {cached_count} served from the response cache (original response times shown)."
+    # Return the dataframe, a success message, make the visualization accordion visible and the plots
+    return (results_df, status, gr.update(visible=True), fig_time, fig_ease, fig_grade)
 
 # --- Visualization Function ---
-def update_visualizations(results_df):
-    """Generates plots from the results DataFrame."""
-    if results_df is None or results_df.empty:
-        return None, None, None
+# (column, chart title) for each plot, in the order they are returned
+PLOT_METRICS = [
+    ('Response Time (s)', 'Response Time by Model and Scenario'),
+    ('Flesch Ease', 'Flesch Reading Ease by Model and Scenario'),
+    ('Flesch-Kincaid Grade', 'Flesch-Kincaid Grade Level by Model and Scenario'),
+]
 
-    # Drop rows where metrics could not be calculated
-    df_clean = results_df.dropna(subset=['Response Time (s)', 'Flesch Ease', 'Flesch-Kincaid Grade'])
-    
-    if df_clean.empty:
+def update_visualizations(viz_df, category_orders=None):
+    """
+    Generates plots from the batch results. Called once at the end of batch_evaluate
+    with the rows of successful requests. Rows without readability scores (responses
+    too short to score) still appear in the response time plot.
+    """
+    if viz_df is None or viz_df.empty:
         return None, None, None
-        
-    # Plot 1: Response Time
-    fig_time = px.bar(df_clean, x='Scenario', y='Response Time (s)', color='Model',
-                      barmode='group', title='Response Time by Model and Scenario')
-    
-    # Plot 2: Flesch Reading Ease
-    fig_ease = px.bar(df_clean, x='Scenario', y='Flesch Ease', color='Model',
-                      barmode='group', title='Flesch Reading Ease by Model and Scenario')
 
-    # Plot 3: Flesch-Kincaid Grade Level
-    fig_grade = px.bar(df_clean, x='Scenario', y='Flesch-Kincaid Grade', color='Model',
-                       barmode='group', title='Flesch-Kincaid Grade Level by Model and Scenario')
+    # Group by model once and build the bar traces for all three plots from the same groups
+    groups = [(name, g) for name, g in viz_df.groupby('Model', sort=False)]
+    if category_orders:
+        model_order = {m: i for i, m in enumerate(category_orders.get('Model', []))}
+        groups.sort(key=lambda item: model_order.get(item[0], len(model_order)))
+    scenario_order = (category_orders or {}).get('Scenario')
 
+    figures = []
+    for metric, title in PLOT_METRICS:
+        # Each plot only leaves out the rows missing its own metric
+        masked = [(name, g[g[metric].notna()]) for name, g in groups]
+        if not any(len(g) for _, g in masked):
+            figures.append(None)
+            continue
+        fig = go.Figure([go.Bar(x=g['Scenario'].to_numpy(), y=g[metric].to_numpy(), name=name)
+                         for name, g in masked])
+        fig.update_layout(barmode='group', title=title, xaxis_title='Scenario', yaxis_title=metric,
+                          legend_title='Model')
+        if scenario_order:
+            fig.update_xaxes(categoryorder='array', categoryarray=scenario_order)
+        figures.append(fig)
+
+    fig_time, fig_ease, fig_grade = figures
     return fig_time, fig_ease, fig_grade
 
 # --- Gradio Interface Definition ---
@@ -176,12 +305,14 @@ with gr.Blocks(theme=gr.themes.Soft(), title="LLM Health Advisor") as demo:
         # --- Batch Comparison Tab ---
         with gr.TabItem("Batch Comparison"):
             with gr.Row():
-                batch_model_select = gr.CheckboxGroup(choices=list(LLM_MODELS_FOR_TESTING.keys()), label="Select Models to Compare")
-                batch_scenario_select = gr.CheckboxGroup(choices=[p['scenario_name'] for p in HEALTH_PROFILES], label="Select Scenarios to Test")
+                batch_model_select = gr.CheckboxGroup(choices=MODEL_NAMES, label="Select Models to Compare")
+                batch_scenario_select = gr.CheckboxGroup(choices=SCENARIO_NAMES, label="Select Scenarios to Test")
             
             with gr.Row():
                 batch_run_btn = gr.Button("Run Batch Evaluation", variant="primary")
                 cancel_btn = gr.Button("Cancel")
+                # Only shown when the response cache is enabled (RESPONSE_CACHE=1)
+                bypass_cache_checkbox = gr.Checkbox(label="Bypass response cache", value=False, visible=RESPONSE_CACHE_ENABLED)
                 
             batch_status_output = gr.Textbox(label="Batch Status", interactive=False)
             results_dataframe = gr.DataFrame(label="Batch Results", wrap=True)
@@ -197,15 +328,8 @@ with gr.Blocks(theme=gr.themes.Soft(), title="LLM Health Advisor") as demo:
             # Event handlers
             click_event = batch_run_btn.click(
                 fn=batch_evaluate,
-                inputs=[batch_model_select, batch_scenario_select],
-                outputs=[results_dataframe, batch_status_output, viz_accordion]
-            )
-            
-            # When the dataframe is updated, generate the plots
-            results_dataframe.change(
-                fn=update_visualizations,
-                inputs=results_dataframe,
-                outputs=[plot_time, plot_ease, plot_grade]
+                inputs=[batch_model_select, batch_scenario_select, bypass_cache_checkbox],
+                outputs=[results_dataframe, batch_status_output, viz_accordion, plot_time, plot_ease, plot_grade]
             )
 
             # Wire the cancel button
@@ -215,14 +339,14 @@ with gr.Blocks(theme=gr.themes.Soft(), title="LLM Health Advisor") as demo:
         with gr.TabItem("Single Model Test"):
             with gr.Row():
                 single_model_select = gr.Dropdown(
-                    choices=list(LLM_MODELS_FOR_TESTING.keys()),
+                    choices=MODEL_NAMES,
                     label="Select LLM Model",
-                    value=list(LLM_MODELS_FOR_TESTING.keys())[0] if LLM_MODELS_FOR_TESTING else None
+                    value=MODEL_NAMES[0] if MODEL_NAMES else None
                 )
                 single_scenario_select = gr.Dropdown(
-                    choices=[p['scenario_name'] for p in HEALTH_PROFILES],
+                    choices=SCENARIO_NAMES,
                     label="Select Health Scenario",
-                    value=[p['scenario_name'] for p in HEALTH_PROFILES][0] if HEALTH_PROFILES else None
+                    value=SCENARIO_NAMES[0] if SCENARIO_NAMES else None
                 )
             
             single_generate_btn = gr.Button("Generate Advice (Streaming)", variant="primary")
@@ -243,4 +367,9 @@ with gr.Blocks(theme=gr.themes.Soft(), title="LLM Health Advisor") as demo:
 
 # This block ensures the app only runs when the script is executed directly
 if __name__ == "__main__":
+    # --- Logging Setup ---
+    print("--- Local LLM Health Advisor ---")
+    print("Models available for testing:", MODEL_NAMES)
+    print("Scenarios available:", SCENARIO_NAMES)
+    print("---------------------------------")
     demo.launch()
\ No newline at end of file
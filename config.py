@@ -2,14 +2,21 @@
 
 # List of models to test. 
 # The key is the user-friendly display name for the Gradio dropdown.
-# The value must match the exact model name from running 'ollama list' in your terminal.
+# "name" must match the exact model name from running 'ollama list' in your terminal.
+# "options" are Ollama runtime options sent with every request for that model, e.g.:
+#   num_thread  - CPU threads per request. The batch tab runs OLLAMA_NUM_PARALLEL requests at once,
+#                 so keep this around (CPU cores / OLLAMA_NUM_PARALLEL) to avoid oversubscribing the CPU.
+#   num_ctx     - Context window size in tokens.
+#   num_predict - Maximum number of tokens to generate.
+# Leave "options" empty to use Ollama's defaults. A plain model tag string (e.g. "qwen:latest")
+# is also accepted and uses Ollama's defaults.
 LLM_MODELS_FOR_TESTING = {
-    "Qwen (Latest Version)": "qwen:latest",
-    "DeepSeek": "deepseek-r1:1.5b", # NOTE: Please verify this name with 'ollama list'
-    "Qwen 0.5B": "qwen:0.5b",
+    "Qwen (Latest Version)": {"name": "qwen:latest", "options": {}},
+    "DeepSeek": {"name": "deepseek-r1:1.5b", "options": {}}, # NOTE: Please verify this name with 'ollama list'
+    "Qwen 0.5B": {"name": "qwen:0.5b", "options": {}},
     # Add any other models you have downloaded from Ollama here. For example:
-    # "Llama 3 8B": "llama3:8b",
-    # "Gemma2 9B": "gemma2:9b",
+    # "Llama 3 8B": {"name": "llama3:8b", "options": {"num_thread": 4, "num_ctx": 2048}},
+    # "Gemma2 9B": {"name": "gemma2:9b", "options": {}},
 }
 
 # --- Evaluation Criteria (For future use, e.g., with an LLM judge) ---
@@ -94,4 +101,9 @@ HEALTH_PROFILES = [
         ],
         "user_question": "I'm 75 and have arthritis, making it hard to exercise much. How can I still improve my heart health without strenuous activity?"
     }
-]
\ No newline at end of file
+]
+
+# --- Lookups derived from HEALTH_PROFILES ---
+# Built once at import so callers don't have to scan the list for every request.
+PROFILE_BY_NAME = {p['scenario_name']: p for p in HEALTH_PROFILES}
+SCENARIO_NAMES = [p['scenario_name'] for p in HEALTH_PROFILES]
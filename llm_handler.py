@@ -1,79 +1,224 @@
 # llm_handler.py
 
+import asyncio
+import hashlib
+import json
+import os
+import httpx
 import ollama
 import time
 
-def get_ollama_response(model_name: str, messages: list):
+# How long Ollama keeps a model loaded after a request, so repeated calls skip the load cost.
+KEEP_ALIVE = "30m"
+
+# Shared clients, so requests reuse pooled keep-alive connections to the Ollama server.
+# Generations can be slow, but a server that isn't running should fail fast.
+_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+_CLIENT = ollama.Client(timeout=_TIMEOUT)
+# Older ollama versions have no AsyncClient; async calls then run the sync client in a worker thread.
+HAS_ASYNC = hasattr(ollama, "AsyncClient")
+_ACLIENT = ollama.AsyncClient(timeout=_TIMEOUT) if HAS_ASYNC else None
+
+# Session-level cache of non-streaming responses, keyed by (model, hash of messages).
+# Off by default because cached hits skip inference; set RESPONSE_CACHE=1 to enable it.
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE: dict[tuple[str, str], tuple[str, float]] = {}
+
+
+def _cache_key(model_name: str, messages: list, options: dict = None) -> tuple[str, str]:
+    """Builds the RESPONSE_CACHE key for a model, its messages and its runtime options."""
+    payload = json.dumps([messages, options], sort_keys=True).encode()
+    digest = hashlib.blake2b(payload, digest_size=16).hexdigest()
+    return model_name, digest
+
+
+async def _acall(method: str, **kwargs):
+    """
+    Calls a client method without blocking the event loop, using AsyncClient when the
+    installed ollama version has it and a worker thread otherwise.
+    """
+    if HAS_ASYNC:
+        return await getattr(_ACLIENT, method)(**kwargs)
+    return await asyncio.to_thread(getattr(_CLIENT, method), **kwargs)
+
+
+def get_ollama_response(model_name: str, messages: list, options: dict = None):
     """
     Gets a streaming response from an Ollama model. This is a generator.
 
     Args:
         model_name: The name of the Ollama model to use (e.g., 'qwen:latest').
         messages: The list of messages (with roles) to send to the model.
+        options: Optional Ollama runtime options (e.g., num_thread, num_ctx, num_predict).
 
     Yields:
-        str: The next chunk of the generated text response or an error message.
+        tuple: (kind, payload), where kind is "content" for the next chunk of the
+        generated text or "error" for an error message, after which the stream ends.
     """
     try:
-        stream = ollama.chat(
+        stream = _CLIENT.chat(
             model=model_name,
             messages=messages,
             stream=True,
+            keep_alive=KEEP_ALIVE,
+            options=options,
         )
         for chunk in stream:
-            if 'message' in chunk and 'content' in chunk['message']:
-                yield chunk['message']['content']
-            elif 'error' in chunk:
+            # Newer ollama versions return response objects; read attributes directly
+            # and only fall back to dict lookups for plain dict chunks.
+            if isinstance(chunk, dict):
+                message = chunk.get('message')
+                content = message.get('content') if message is not None else None
+            else:
+                message = getattr(chunk, 'message', None)
+                content = getattr(message, 'content', None)
+            if content:
+                yield "content", content
+                continue
+
+            error = chunk.get('error') if isinstance(chunk, dict) else getattr(chunk, 'error', None)
+            if error:
                 # This handles model not found errors during streaming
-                error_message = f"ERROR: Ollama stream error for model '{model_name}'.\nDetails: {chunk['error']}"
+                error_message = f"ERROR: Ollama stream error for model '{model_name}'.\nDetails: {error}"
                 print(error_message)
-                yield error_message
+                yield "error", error_message
                 return
 
     except ollama.ResponseError as e:
         # This handles errors from the Ollama server itself, e.g., "model not found"
         error_message = f"ERROR: Ollama response error for model '{model_name}'.\nDetails: {e.error}"
         print(error_message) # Also print to console for debugging
-        yield error_message
+        yield "error", error_message
         
     except Exception as e:
         # This catches other exceptions, like connection errors if the server isn't running
         error_message = f"ERROR: Could not connect to the Ollama server. Please ensure it is running.\nDetails: {e}"
         print(error_message) # Also print to console for debugging
-        yield error_message
+        yield "error", error_message
 
 
-def get_ollama_response_non_stream(model_name: str, messages: list) -> (str, float):
+def _cache_get(model_name: str, messages: list, options: dict, use_cache: bool):
+    """Returns the cached (advice_text, response_time) for a request, or None on a miss or when caching is off."""
+    if not (use_cache and RESPONSE_CACHE_ENABLED):
+        return None
+    return RESPONSE_CACHE.get(_cache_key(model_name, messages, options))
+
+
+def _cache_put(model_name: str, messages: list, options: dict, use_cache: bool, advice_text: str, response_time: float):
+    """Stores a successful response in RESPONSE_CACHE. Callers skip errors so they are retried on the next run."""
+    if use_cache and RESPONSE_CACHE_ENABLED:
+        RESPONSE_CACHE[_cache_key(model_name, messages, options)] = (advice_text, response_time)
+
+
+def _parse_chat_response(model_name: str, response) -> (str, str):
+    """Extracts (advice text, "ok") from a non-streaming chat response, or (error message, "error")."""
+    if 'message' in response and 'content' in response['message']:
+        return response['message']['content'], "ok"
+    if 'error' in response:
+        return f"ERROR: Ollama error for model '{model_name}'. Details: {response['error']}", "error"
+    return "ERROR: Unknown response format from Ollama.", "error"
+
+
+def _chat_exception_message(model_name: str, e: Exception) -> str:
+    """Formats an exception raised by a non-streaming chat call as an error message."""
+    if isinstance(e, ollama.ResponseError):
+        return f"ERROR: Ollama response error for model '{model_name}'. Details: {e.error}"
+    return f"ERROR: Could not connect to the Ollama server. Details: {e}"
+
+
+def get_ollama_response_non_stream(model_name: str, messages: list, options: dict = None, use_cache: bool = True) -> (str, float, str):
     """
     Gets a single, complete response from an Ollama model and the response time.
 
     Args:
         model_name: The name of the Ollama model to use.
         messages: The list of messages to send.
+        options: Optional Ollama runtime options (e.g., num_thread, num_ctx, num_predict).
+        use_cache: Whether to read from and store into RESPONSE_CACHE (only when RESPONSE_CACHE_ENABLED).
 
     Returns:
-        A tuple containing the full response text (or error) and the response time.
+        A tuple containing the full response text (or error message), the response time and
+        a status: "ok", "cached" (served from RESPONSE_CACHE, with the response time of the
+        original request) or "error".
     """
-    advice_text = ""
+    cached = _cache_get(model_name, messages, options, use_cache)
+    if cached is not None:
+        return *cached, "cached"
+
     start_time = time.time()
     try:
-        response = ollama.chat(
+        response = _CLIENT.chat(
             model=model_name,
             messages=messages,
             stream=False, # The only change needed for a non-streaming call
+            keep_alive=KEEP_ALIVE,
+            options=options,
         )
-        if 'message' in response and 'content' in response['message']:
-            advice_text = response['message']['content']
-        elif 'error' in response:
-            advice_text = f"ERROR: Ollama error for model '{model_name}'. Details: {response['error']}"
-        else:
-            advice_text = "ERROR: Unknown response format from Ollama."
-
-    except ollama.ResponseError as e:
-        advice_text = f"ERROR: Ollama response error for model '{model_name}'. Details: {e.error}"
+        advice_text, status = _parse_chat_response(model_name, response)
     except Exception as e:
-        advice_text = f"ERROR: Could not connect to the Ollama server. Details: {e}"
+        advice_text, status = _chat_exception_message(model_name, e), "error"
 
     response_time = time.time() - start_time
     print(f"Non-stream response for {model_name} took {response_time:.2f}s") # For debugging
-    return advice_text, response_time
\ No newline at end of file
+    if status == "ok":
+        _cache_put(model_name, messages, options, use_cache, advice_text, response_time)
+    return advice_text, response_time, status
+
+
+async def get_ollama_response_async(model_name: str, messages: list, options: dict = None, use_cache: bool = True) -> (str, float, str):
+    """
+    Async counterpart of get_ollama_response_non_stream, used by the batch tab so
+    several requests can be in flight against the Ollama server at once.
+
+    Args and return value are the same as get_ollama_response_non_stream.
+    """
+    cached = _cache_get(model_name, messages, options, use_cache)
+    if cached is not None:
+        return *cached, "cached"
+
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    try:
+        response = await _acall(
+            "chat",
+            model=model_name,
+            messages=messages,
+            stream=False,
+            keep_alive=KEEP_ALIVE,
+            options=options,
+        )
+        advice_text, status = _parse_chat_response(model_name, response)
+    except Exception as e:
+        advice_text, status = _chat_exception_message(model_name, e), "error"
+
+    response_time = loop.time() - start_time
+    print(f"Async response for {model_name} took {response_time:.2f}s") # For debugging
+    if status == "ok":
+        _cache_put(model_name, messages, options, use_cache, advice_text, response_time)
+    return advice_text, response_time, status
+
+
+async def warmup_models(models: dict):
+    """
+    Loads each model into Ollama's memory before a batch run so that measured
+    response times reflect inference only, not model load time.
+
+    Args:
+        models: Maps each Ollama model name to preload to its runtime options.
+            The same options are used as in the real requests, since a different
+            num_ctx would make Ollama reload the model.
+    """
+    async def warmup(model_name, options):
+        try:
+            await _acall(
+                "generate",
+                model=model_name,
+                prompt="",
+                keep_alive=KEEP_ALIVE,
+                options={**(options or {}), "num_predict": 1},
+            )
+        except Exception as e:
+            # A failed warmup is not fatal; the real request will report the error.
+            print(f"Warmup failed for model '{model_name}'. Details: {e}")
+
+    await asyncio.gather(*(warmup(name, options) for name, options in models.items()))
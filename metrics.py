@@ -0,0 +1,78 @@
+# metrics.py
+
+import atexit
+import os
+from concurrent.futures import ProcessPoolExecutor
+from textstat import textstat as ts
+
+# textstat's backend caches the base counts (words, sentences, syllables) per text, so computing
+# both scores back to back reuses them. The default language (en_US) is kept so scores stay
+# comparable with earlier runs.
+
+def compute_readability(text: str) -> (float, float):
+    """
+    Computes the readability scores for a generated response.
+
+    Args:
+        text: The text to score.
+
+    Returns:
+        A tuple containing the Flesch Reading Ease and Flesch-Kincaid Grade scores.
+    """
+    return ts.flesch_reading_ease(text), ts.flesch_kincaid_grade(text)
+
+
+# Responses shorter than this give unstable Flesch scores, so they are not scored.
+MIN_READABILITY_CHARS = 100
+
+def safe_readability(text: str, is_error: bool = False) -> (float, float):
+    """
+    Computes the readability scores, skipping texts that can't be scored meaningfully.
+
+    Args:
+        text: The generated response (or error message).
+        is_error: True if the text is an error message rather than a generated response.
+
+    Returns:
+        A tuple containing the Flesch Reading Ease and Flesch-Kincaid Grade scores,
+        or (None, None) if the text is an error or shorter than MIN_READABILITY_CHARS.
+    """
+    if is_error or len(text) < MIN_READABILITY_CHARS:
+        return None, None
+    return compute_readability(text)
+
+
+
+# --- Readability Worker Pool ---
+# textstat is pure Python and holds the GIL, so batch scoring runs in worker processes where it
+# overlaps with the Ollama requests still in flight. The pool is created on first use and reused.
+# Note that with the "spawn" start method (macOS, Windows) each worker re-imports the main module
+# once when it starts, so the pool is kept small and alive instead of being rebuilt per batch.
+_READABILITY_POOL = None
+
+def get_readability_pool(max_workers: int) -> ProcessPoolExecutor:
+    """
+    Returns the shared readability pool, creating it on first use.
+
+    Args:
+        max_workers: Upper bound on worker processes; capped at the number of CPU cores.
+    """
+    global _READABILITY_POOL
+    if _READABILITY_POOL is None:
+        _READABILITY_POOL = ProcessPoolExecutor(max_workers=max(1, min(os.cpu_count() or 1, max_workers)))
+    return _READABILITY_POOL
+
+def reset_readability_pool(pool: ProcessPoolExecutor = None):
+    """
+    Shuts down the shared pool (e.g. after a worker died) so the next call creates a fresh one.
+
+    Args:
+        pool: If given, only reset when this is still the shared pool, so several tasks
+            failing on the same broken pool don't shut down its replacement.
+    """
+    global _READABILITY_POOL
+    if _READABILITY_POOL is not None and (pool is None or pool is _READABILITY_POOL):
+        _READABILITY_POOL.shutdown(wait=False, cancel_futures=True)
+        _READABILITY_POOL = None
+
+atexit.register(reset_readability_pool)